@@ -50,6 +50,21 @@
 """
 import pygame
 import math
+import collections
+import json
+import os
+import random
+import struct
+import time
+import queue
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ################
 # PYGAME SETUP #
@@ -78,6 +93,35 @@ GRID_SPACING = 1
 
 FRAMERATE = 2
 
+##############
+# STATISTICS #
+##############
+
+BLOCK_SIZE = 10 # side length (cells) of each block in the summary grid
+HISTORY_LENGTH = 1000 # generations kept in World.history
+
+#################
+# SHARED MEMORY #
+#################
+
+# sequence, generation, rows, cols - followed by one byte (CELLS_INDEX) per cell
+SHARED_HEADER = struct.Struct("<QQII")
+SHARED_RETRY_DELAY = 0.0001 # seconds readers sleep while a write is in progress
+SHARED_TRACKER_LOCK = threading.Lock() # see SharedWorldReader.__init__
+
+###############
+# SEED SEARCH #
+###############
+
+SEARCH_GENERATIONS = 200 # generation budget of each candidate
+SEARCH_STABLE_PERIOD = 6 # candidates repeating a board within this many generations are stopped
+SEARCH_TOP_K = 10
+SEARCH_MUTATION_RATE = 0.05 # chance of each cell of a mutated seed being redrawn
+SEARCH_MUTATE_FRACTION = 0.5 # share of candidates mutated from the leaderboard
+SEARCH_MUTATION_TRIES = 10 # mutations that leave the parent unchanged are redrawn this often
+SEARCH_QUEUE_DEPTH = 2 # candidates per process queued ahead so workers never wait
+SEARCH_SAVE_EVERY = 100 # candidates evaluated between leaderboard saves
+
 
 class Cell(pygame.sprite.Sprite):
     """A cell in the game."""
@@ -176,7 +220,7 @@ class Cell(pygame.sprite.Sprite):
     def revive(self):
         """Turns a cell's identity to live in the cell's world."""
         assert self.identity == "inactive" or self.identity == "diseased", "Cannot apply revive to %s cell" %self.identity
-        self.identity = "live"
+        self.world.change_this_cell_identity("live", self)
 
     def remove(self):
         """Turns the cell's identity to inactive in the cell's world.""" #FIXME can probably just do self.identity = inactive
@@ -317,6 +361,16 @@ class World(object):
         self.cells = [[Cell(self, i, j) for j in range(cols)] for i in range(rows)]
         self.ticks = 0
 
+        # maintained by change_cell_identity as identities change
+        self.population = dict((identity, 0) for identity in CELLS_INDEX)
+        self.population["inactive"] = rows * cols
+        self.score = 0
+        self.blocks = self.count_blocks()
+        self.history = collections.deque(maxlen=HISTORY_LENGTH)
+
+        # set by SharedWorld when the world is published
+        self.publisher = None
+
         self.setup_cells()
 
     def __repr__(self):
@@ -337,7 +391,13 @@ class World(object):
 
     def change_cell_identity(self, new, row, col):
         """Changes the cell identity at position (row, col) with the new one."""
+        old = self.cells[row][col].identity
+        if old == new:
+            return
         self.cells[row][col].identity = new
+        self.count_change(old, new, row, col)
+        if self.publisher:
+            self.publisher.set_cell(row, col, new)
 
     def change_this_cell_identity(self, new, cell):
         """Changes the cell identity of an existing cell."""
@@ -346,20 +406,36 @@ class World(object):
 
     def replace_cell(self, new, row, col):
         """Replaces the cell at position (row, col) with the new cell."""
+        old = self.cells[row][col].identity
         self.cells[row][col] = new
+        if old != new.identity:
+            self.count_change(old, new.identity, row, col)
+            if self.publisher:
+                self.publisher.set_cell(row, col, new.identity)
 
     def remove_cell(self, row, col):
         """Changes the identity of cell at position (row, col) to inactive."""
-        this_cell = self.get_cell(row, col)
-        this_cell.identity = "inactive"
+        self.change_cell_identity("inactive", row, col)
 
     def initialize(self, initial):
-        """Initializes or overwrites the world with a given configuration."""
+        """Initializes or overwrites the world with a given configuration, and
+        starts a new history with it as the first generation."""
         assert len(initial) == self.rows and len(initial[0]) == self.cols, "Bad dimensions"
-        for i in range(self.rows):
-            for j in range(self.cols):
-                initial_cell_type = CELLS[initial[i][j]]
-                self.change_cell_identity(initial_cell_type, i, j)
+        self.set_cells(initial)
+        self.history.clear()
+        self.record_statistics()
+
+    def set_cells(self, configuration):
+        """Changes the identities of all cells to the given configuration."""
+        if self.publisher: # readers only see the whole configuration
+            self.publisher.begin()
+        try:
+            for i in range(self.rows):
+                for j in range(self.cols):
+                    self.change_cell_identity(CELLS[configuration[i][j]], i, j)
+        finally:
+            if self.publisher:
+                self.publisher.commit()
 
     def cache_neighbors(self):
         """Sets the instance variables neighbors/adjacent/diagonals of the
@@ -380,6 +456,64 @@ class World(object):
         self.cache_neighbors()
         self.cache_static()
 
+    ##############
+    # STATISTICS #
+    ##############
+
+    def count_blocks(self):
+        """Counts the summary grid from scratch: a list of lists of dictionaries with
+        the frequencies of each type of cell in every BLOCK_SIZE x BLOCK_SIZE block."""
+        block_rows = int(math.ceil(float(self.rows) / BLOCK_SIZE))
+        block_cols = int(math.ceil(float(self.cols) / BLOCK_SIZE))
+        blocks = [[dict((identity, 0) for identity in CELLS_INDEX)
+            for j in range(block_cols)] for i in range(block_rows)]
+        for row in self.cells:
+            for cell in row:
+                blocks[cell.row // BLOCK_SIZE][cell.col // BLOCK_SIZE][cell.identity] += 1
+        return blocks
+
+    def count_change(self, old, new, row, col):
+        """Updates the population, score and summary grid after the cell at
+        position (row, col) changed from identity old to new."""
+        self.population[old] -= 1
+        self.population[new] += 1
+        self.score += SCORES.get(new, 0) - SCORES.get(old, 0)
+        block = self.blocks[row // BLOCK_SIZE][col // BLOCK_SIZE]
+        block[old] -= 1
+        block[new] += 1
+
+    def get_population(self, identity=None):
+        """Returns the number of cells of a given identity, or a dictionary of
+        the frequencies of every identity."""
+        if identity is None:
+            return dict(self.population)
+        return self.population[identity]
+
+    def get_score(self):
+        """Returns the current score (see SCORES)."""
+        return self.score
+
+    def get_block(self, row, col):
+        """Returns a dictionary of the frequencies of each type of cell in the
+        block containing position (row, col)."""
+        return dict(self.blocks[row // BLOCK_SIZE][col // BLOCK_SIZE])
+
+    def get_blocks(self):
+        """Returns a copy of the summary grid (see count_blocks)."""
+        return [[dict(block) for block in row] for row in self.blocks]
+
+    def record_statistics(self):
+        """Appends (ticks, population, score) of the current generation to the
+        history. Only the last HISTORY_LENGTH generations are kept."""
+        self.history.append((self.ticks, dict(self.population), self.score))
+
+    def get_history(self, identity=None):
+        """Returns a list of (ticks, population, score) for recent generations.
+        If an identity is given, population is the number of cells of that identity."""
+        if identity is None:
+            return list(self.history)
+        return [(ticks, population[identity], score) for ticks, population, score in self.history]
+
     #######################
     # GAME LOOP FUNCTIONS #
     #######################
@@ -404,8 +538,358 @@ class World(object):
                 this_row.append(CELLS_INDEX[result_identity])
             updated.append(this_row)
 
-        self.initialize(updated)
-        self.ticks += 1
+        publisher = self.publisher
+        if publisher: # commits the new board with the new generation
+            publisher.begin()
+        try:
+            self.set_cells(updated)
+            self.ticks += 1
+            self.record_statistics()
+        finally:
+            if publisher:
+                publisher.commit()
+
+
+class SharedWorld(object):
+    """Publishes the identity grid of a world in a shared memory block, so that
+    other processes can read it with SharedWorldReader without copying or pickling.
+
+    Writes are guarded by a sequence lock: the sequence is odd while the grid is
+    being written and even once it is consistent. A world can only have one publisher."""
+    def __init__(self, world, name=None):
+        assert world.publisher is None, "%s is already published by %s" %(repr(world), repr(world.publisher))
+        self.world = world
+        size = SHARED_HEADER.size + world.rows * world.cols
+        with SHARED_TRACKER_LOCK:
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.memory.name
+        self.grid = self.memory.buf[SHARED_HEADER.size:size]
+        self.sequence = 0
+        self.writing = 0 # depth of nested begin calls
+
+        SHARED_HEADER.pack_into(self.memory.buf, 0, 0, world.ticks, world.rows, world.cols)
+        self.publish()
+        world.publisher = self
+
+    def __repr__(self):
+        return "SharedWorld(%s, '%s')" %(repr(self.world), self.name)
+
+    def begin(self):
+        """Marks the grid as being written (odd sequence). Calls can be nested,
+        only the outermost begin/commit pair is seen by readers."""
+        self.writing += 1
+        if self.writing == 1:
+            self.sequence += 1
+            struct.pack_into("<Q", self.memory.buf, 0, self.sequence)
+
+    def commit(self):
+        """Stores the current generation and marks the grid as consistent (even sequence)."""
+        assert self.writing > 0, "commit called without begin"
+        self.writing -= 1
+        if self.writing == 0:
+            struct.pack_into("<Q", self.memory.buf, 8, self.world.ticks)
+            self.sequence += 1
+            struct.pack_into("<Q", self.memory.buf, 0, self.sequence)
+
+    def set_cell(self, row, col, identity):
+        """Writes the identity of the cell at position (row, col). Called by
+        World.change_cell_identity, outside of a write it is committed right away."""
+        self.begin()
+        self.grid[row * self.world.cols + col] = CELLS_INDEX[identity]
+        self.commit()
+
+    def publish(self):
+        """Writes the whole world to the shared memory block."""
+        self.begin()
+        cols = self.world.cols
+        for row in self.world.cells:
+            for cell in row:
+                self.grid[cell.row * cols + cell.col] = CELLS_INDEX[cell.identity]
+        self.commit()
+
+    def close(self):
+        """Stops publishing the world and frees the shared memory block. Does
+        nothing if already closed."""
+        if self.world.publisher is self:
+            self.world.publisher = None
+        if self.memory is None:
+            return
+        self.grid.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.grid, self.memory = None, None
+
+
+class SharedWorldReader(object):
+    """Reads a world published by SharedWorld, possibly from another process."""
+    def __init__(self, name):
+        try:
+            self.memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching also registers the block, so the resource
+            # tracker would unlink it when this process exits. Registering is turned
+            # off for the whole process while attaching, under SHARED_TRACKER_LOCK
+            # which SharedWorld also holds while creating its block. Blocks created
+            # by other code in another thread during the attach are not registered;
+            # avoiding that would take the private _posixshmem module instead.
+            from multiprocessing import resource_tracker
+            with SHARED_TRACKER_LOCK:
+                register, resource_tracker.register = resource_tracker.register, lambda name, rtype: None
+                try:
+                    self.memory = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+        self.name = name
+        sequence, generation, self.rows, self.cols = SHARED_HEADER.unpack_from(self.memory.buf, 0)
+        self.grid = self.memory.buf[SHARED_HEADER.size:SHARED_HEADER.size + self.rows * self.cols]
+
+    def __repr__(self):
+        return "SharedWorldReader('%s')" %self.name
+
+    @property
+    def sequence(self):
+        """Returns the current sequence number of the writer."""
+        return struct.unpack_from("<Q", self.memory.buf, 0)[0]
+
+    @property
+    def generation(self):
+        """Returns the generation (World.ticks) of the last committed grid."""
+        return struct.unpack_from("<Q", self.memory.buf, 8)[0]
+
+    def array(self):
+        """Returns a (rows, cols) view of the shared grid of CELLS_INDEX values,
+        a NumPy array if NumPy is installed and a memoryview otherwise. The view
+        is not copied, so it should be read between begin and validate, and
+        dropped before calling close."""
+        if numpy is not None:
+            return numpy.ndarray((self.rows, self.cols), dtype=numpy.uint8, buffer=self.grid)
+        return self.grid.cast("B", (self.rows, self.cols))
+
+    def begin(self, timeout=None):
+        """Waits until no write is in progress and returns the sequence number.
+        Raises TimeoutError if the write takes longer than timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        sequence = self.sequence
+        while sequence % 2:
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("%s is still being written after %s seconds" %(self.name, timeout))
+            time.sleep(SHARED_RETRY_DELAY)
+            sequence = self.sequence
+        return sequence
+
+    def validate(self, sequence):
+        """Returns whether the grid was not written since begin returned sequence."""
+        return self.sequence == sequence
+
+    def read(self, function, timeout=None):
+        """Returns function(array, generation) computed on a consistent grid,
+        retrying while the writer interferes for at most timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            sequence = self.begin(remaining)
+            result = function(self.array(), self.generation)
+            if self.validate(sequence):
+                return result
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("%s kept changing during reads for %s seconds" %(self.name, timeout))
+
+    def snapshot(self, timeout=None):
+        """Returns a consistent (generation, bytes) copy of the grid."""
+        return self.read(lambda array, generation: (generation, self.grid.tobytes()), timeout)
+
+    def close(self):
+        """Detaches from the shared memory block without freeing it. Returns
+        whether it is detached: while views returned by array are still alive
+        only what can be released is, and close should be called again once
+        they are dropped."""
+        if self.memory is None:
+            return True
+        if self.grid is not None:
+            try:
+                self.grid.release()
+                self.grid = None
+            except BufferError: # a NumPy array still uses the grid
+                return False
+        try:
+            self.memory.close()
+        except BufferError: # a memoryview from array still uses the block
+            return False
+        self.memory = None
+        return True
+
+
+def check_densities(densities):
+    """Raises ValueError unless densities maps known identities to probabilities
+    that add up to at most 1."""
+    for identity in densities:
+        if identity not in CELLS_INDEX:
+            raise ValueError("Unknown identity '%s' in densities" %identity)
+        if densities[identity] < 0:
+            raise ValueError("Negative density for '%s' cells" %identity)
+    if sum(densities.values()) > 1:
+        raise ValueError("Densities add up to %s, more than 1" %sum(densities.values()))
+
+def check_settings(rows, cols, densities, generations, k, scores):
+    """Raises ValueError unless the settings of a search are usable."""
+    for name, value, least in [("rows", rows, 1), ("cols", cols, 1), ("k", k, 1),
+                               ("generations", generations, 0)]:
+        if not isinstance(value, int) or value < least:
+            raise ValueError("%s must be an integer of at least %s, not %s" %(name, least, repr(value)))
+    check_densities(densities)
+    for identity in scores:
+        if identity not in CELLS_INDEX:
+            raise ValueError("Unknown identity '%s' in scores" %identity)
+
+def seed_key(seed):
+    """Returns a hashable version of seed, to compare seeds with."""
+    return tuple(map(tuple, seed))
+
+def random_cell(densities, rng=random):
+    """Returns a random cell index, where densities maps identities to the
+    probability of a cell having them (the rest are inactive)."""
+    chance = rng.random()
+    for identity in densities:
+        chance -= densities[identity]
+        if chance < 0:
+            return CELLS_INDEX[identity]
+    return CELLS_INDEX["inactive"]
+
+def random_seed(rows, cols, densities, rng=random):
+    """Returns a random initial configuration with rows, cols."""
+    return [[random_cell(densities, rng) for j in range(cols)] for i in range(rows)]
+
+def mutate_seed(seed, densities, rate=SEARCH_MUTATION_RATE, rng=random):
+    """Returns a copy of seed where each cell is redrawn with probability rate."""
+    return [[random_cell(densities, rng) if rng.random() < rate else index for index in row]
+        for row in seed]
+
+def evaluate_seed(seed, generations=SEARCH_GENERATIONS, scores=None):
+    """Plays seed for at most generations ticks and returns a leaderboard entry,
+    with the final population and its fitness weighted by scores (default SCORES).
+    Stops early once every cell is inactive, or the board repeats itself within
+    SEARCH_STABLE_PERIOD generations (still lifes and small oscillators)."""
+    scores = SCORES if scores is None else scores
+    rows, cols = len(seed), len(seed[0])
+    world = World("Search", rows, cols)
+    world.initialize(seed)
+    recent = collections.deque(maxlen=SEARCH_STABLE_PERIOD)
+    while world.ticks < generations:
+        world.tick()
+        if world.get_population("inactive") == rows * cols:
+            break
+        board = hash(bytes(CELLS_INDEX[cell.identity] for row in world.cells for cell in row))
+        if board in recent:
+            break
+        recent.append(board)
+    population = world.get_population()
+    fitness = sum(scores[identity] * population[identity] for identity in scores)
+    return {"fitness": fitness, "generations": world.ticks, "population": population, "seed": seed}
+
+
+class Leaderboard(object):
+    """The top k entries with distinct seeds found by search, best first, saved
+    as JSON at path together with the settings they were found with."""
+    def __init__(self, path, rows, cols, densities, generations=SEARCH_GENERATIONS,
+                 k=SEARCH_TOP_K, scores=None):
+        scores = SCORES if scores is None else scores
+        check_settings(rows, cols, densities, generations, k, scores)
+        self.path = path
+        self.settings = {"rows": rows, "cols": cols, "densities": dict(densities),
+                         "generations": generations, "k": k, "scores": dict(scores)}
+        self.k = k
+        self.entries = []
+        if os.path.exists(path):
+            with open(path) as leaderboard_file:
+                saved = json.load(leaderboard_file)
+            if not isinstance(saved, dict) or saved.get("settings") != self.settings:
+                raise ValueError("Leaderboard %s was saved with other settings than %s"
+                                 %(path, self.settings))
+            for entry in saved["entries"]:
+                self.add(entry)
+
+    def __repr__(self):
+        return "Leaderboard('%s', %s, %s, %s, %s, %s, %s)" %(self.path, self.settings["rows"],
+            self.settings["cols"], self.settings["densities"], self.settings["generations"],
+            self.k, self.settings["scores"])
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def worst(self):
+        """Returns the lowest fitness needed to enter the leaderboard."""
+        if len(self.entries) < self.k:
+            return None
+        return self.entries[-1]["fitness"]
+
+    def add(self, entry):
+        """Adds entry if it ranks in the top k and its seed is not already on the
+        leaderboard. Returns whether it was added."""
+        if self.worst is not None and entry["fitness"] <= self.worst:
+            return False
+        key = seed_key(entry["seed"])
+        if any(seed_key(other["seed"]) == key for other in self.entries):
+            return False
+        entries = self.entries + [entry]
+        entries.sort(key=lambda entry: entry["fitness"], reverse=True)
+        self.entries = entries[:self.k]
+        return True
+
+    def save(self):
+        """Writes the leaderboard to path."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as leaderboard_file:
+            json.dump({"settings": self.settings, "entries": self.entries}, leaderboard_file)
+        os.replace(temporary, self.path)
+
+
+def search(rows, cols, densities, candidates, path, generations=SEARCH_GENERATIONS,
+           k=SEARCH_TOP_K, processes=None, random_state=None, scores=None):
+    """Evaluates candidates random or mutated seeds with rows, cols across a
+    process pool and returns the top k, which are kept in the leaderboard at path.
+    densities maps identities to the probability of a random cell having them,
+    and scores the points each cell is worth towards the fitness (default SCORES).
+
+    A new candidate is submitted as soon as one finishes, so workers stay busy
+    while the leaderboard is updated and saved every SEARCH_SAVE_EVERY candidates."""
+    scores = SCORES if scores is None else scores
+    rng = random.Random(random_state)
+    leaderboard = Leaderboard(path, rows, cols, densities, generations, k, scores)
+    processes = processes or os.cpu_count() or 1
+    finished = queue.Queue()
+
+    def next_seed():
+        if leaderboard.entries and rng.random() < SEARCH_MUTATE_FRACTION:
+            parent = rng.choice(leaderboard.entries)["seed"]
+            if len(parent) == rows and len(parent[0]) == cols:
+                for i in range(SEARCH_MUTATION_TRIES):
+                    seed = mutate_seed(parent, densities, rng=rng)
+                    if seed != parent:
+                        return seed
+        return random_seed(rows, cols, densities, rng)
+
+    pool = multiprocessing.Pool(processes)
+    submitted, running = 0, 0
+    try:
+        while submitted < candidates or running:
+            while submitted < candidates and running < SEARCH_QUEUE_DEPTH * processes:
+                pool.apply_async(evaluate_seed, (next_seed(), generations, scores),
+                                 callback=finished.put, error_callback=finished.put)
+                submitted += 1
+                running += 1
+            entry = finished.get()
+            running -= 1
+            if isinstance(entry, BaseException):
+                raise entry
+            leaderboard.add(entry)
+            if (submitted - running) % SEARCH_SAVE_EVERY == 0:
+                leaderboard.save()
+        leaderboard.save()
+    finally:
+        pool.terminate()
+        pool.join()
+    return leaderboard.entries
 
 
 class Display(pygame.sprite.Sprite):
@@ -592,6 +1076,13 @@ COLORS = {
     "money": BLING
 }
 
+# Points each cell is worth towards the score. A skyscraper counts as itself
+# plus the (up to 4) money cells it creates on its diagonals by BLING BLING.
+SCORES = {
+    "skyscraper": 5,
+    "money": 1
+}
+
 # Comment rules to deactivate them for the game
 INACTIVE_RULES = [
     Cell.apply_metropolis,
@@ -696,7 +1187,8 @@ def draw(rows, cols):
     display.draw_initial()
     drawing_board = Drawing(display)
     pygame.quit()
-# play(9, 14, sample_initial)
-play(20, 30, same_level)
-# draw(100, 200)
-# play(100, 200, big100_200)
+if __name__ == "__main__":
+    # play(9, 14, sample_initial)
+    play(20, 30, same_level)
+    # draw(100, 200)
+    # play(100, 200, big100_200)
@@ -0,0 +1,116 @@
+"""Tests for the statistics, shared memory and seed search of life.py."""
+import multiprocessing
+
+import pytest
+
+import life
+
+
+def count(world):
+    """Returns the population, score and blocks of world from a full scan."""
+    population = dict((identity, 0) for identity in life.CELLS_INDEX)
+    for row in world.cells:
+        for cell in row:
+            population[cell.identity] += 1
+    score = sum(life.SCORES.get(identity, 0) * population[identity] for identity in population)
+    return population, score, world.count_blocks()
+
+
+def test_statistics_match_full_scan():
+    world = life.World("Test", 20, 30)
+    world.initialize(life.same_level)
+    for i in range(30):
+        world.tick()
+        population, score, blocks = count(world)
+        assert world.get_population() == population
+        assert world.get_score() == score
+        assert world.get_blocks() == blocks
+
+
+def test_history_starts_at_initialize():
+    world = life.World("Test", 20, 30)
+    world.initialize(life.same_level)
+    for i in range(3):
+        world.tick()
+    world.initialize(life.sample_initial)
+    history = world.get_history("live")
+    assert history == [(world.ticks, 0, 0)]
+    world.tick()
+    assert len(world.get_history()) == 2
+
+
+def read_snapshot(name, results):
+    """Sends the snapshot of a published world, from another process."""
+    reader = life.SharedWorldReader(name)
+    results.put(reader.snapshot(timeout=10))
+    reader.close()
+
+
+def test_snapshot_in_spawned_process():
+    world = life.World("Test", 20, 30)
+    world.initialize(life.same_level)
+    publisher = life.SharedWorld(world)
+    try:
+        for i in range(5):
+            world.tick()
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        process = context.Process(target=read_snapshot, args=(publisher.name, results))
+        process.start()
+        generation, grid = results.get(timeout=30)
+        process.join()
+        assert generation == world.ticks
+        assert grid == bytes(life.CELLS_INDEX[cell.identity] for row in world.cells for cell in row)
+    finally:
+        publisher.close()
+
+
+def test_read_times_out_while_writer_keeps_committing():
+    world = life.World("Test", 4, 4)
+    publisher = life.SharedWorld(world)
+    reader = life.SharedWorldReader(publisher.name)
+
+    def interfere(array, generation):
+        publisher.begin()
+        publisher.commit()
+
+    try:
+        with pytest.raises(TimeoutError):
+            reader.read(interfere, timeout=0.05)
+    finally:
+        reader.close()
+        publisher.close()
+
+
+def test_leaderboard_save_and_reload(tmp_path):
+    path = str(tmp_path / "leaderboard.json")
+    densities = {"live": 0.3, "water": 0.05}
+    leaderboard = life.Leaderboard(path, 8, 8, densities, 20, k=2)
+    for seed in [life.random_seed(8, 8, densities) for i in range(3)]:
+        leaderboard.add(life.evaluate_seed(seed, 20))
+    leaderboard.save()
+    assert life.Leaderboard(path, 8, 8, densities, 20, k=2).entries == leaderboard.entries
+    with pytest.raises(ValueError):
+        life.Leaderboard(path, 10, 10, densities, 20, k=2)
+    with pytest.raises(ValueError):
+        life.Leaderboard(path, 8, 8, densities, 30, k=2)
+
+
+def test_leaderboard_keeps_distinct_seeds(tmp_path):
+    leaderboard = life.Leaderboard(str(tmp_path / "leaderboard.json"), 8, 8, {"live": 0.3})
+    entry = life.evaluate_seed(life.random_seed(8, 8, {"live": 0.3}), 20)
+    assert leaderboard.add(entry)
+    assert not leaderboard.add(dict(entry))
+    assert len(leaderboard) == 1
+
+
+def test_search_settings_are_validated(tmp_path):
+    path = str(tmp_path / "leaderboard.json")
+    with pytest.raises(ValueError):
+        life.search(8, 8, {"gold": 0.1}, 1, path)
+    with pytest.raises(ValueError):
+        life.search(8, 8, {"live": 0.8, "fire": 0.5}, 1, path)
+    with pytest.raises(ValueError):
+        life.search(0, 8, {"live": 0.3}, 1, path)
+    with pytest.raises(ValueError):
+        life.search(8, 8, {"live": 0.3}, 1, path, k=0)